@@ -1,14 +1,14 @@
 import asyncio
 import configparser
-import datetime
-import json
 import logging
 import os
-from json import JSONDecodeError
+import time
+import zlib
 from logging.handlers import TimedRotatingFileHandler
-from typing import Optional, Union
+from typing import Dict, Optional, Union
 
 import discord
+import orjson
 from discord.ext import commands, tasks
 
 try:
@@ -42,9 +42,25 @@ discord_log = logging.getLogger("discord")
 discord_log.setLevel(logging.INFO)
 discord_log.addHandler(discord_file_handler)
 
+QUEUE_SNAPSHOT_PATH = "queue.json"
+QUEUE_JOURNAL_PATH = "queue.jsonl"
+# Maximum number of simultaneous discord requests when syncing queue entries.
+MAX_CONCURRENT_REQUESTS = 5
+# Minimum seconds between mod queue checks, regardless of the Reddit rate limit.
+MIN_QUEUE_CHECK_INTERVAL = 30
+# Minimum seconds between subscriber count updates.
+SUBSCRIBER_CHECK_INTERVAL = 360
+# Approximate size of a single journal record, used to decide when to compact.
+JOURNAL_RECORD_SIZE = 64
+
 COMMENT_COLOR = discord.colour.Colour.green()
 LINK_COLOR = discord.colour.Colour.gold()
 
+# Formats a user report (reason, count, ...) as "count: reason"
+_REPORT_FMT = "{0[1]}: {0[0]}".format
+# Formats a mod report (reason, author) as "author: reason"
+_MODREPORT_FMT = "{0[1]}: {0[0]}".format
+
 if sentry_sdk and os.getenv("SENTRY_DSN"):
     sentry_sdk.init(
         dsn=os.getenv("SENTRY_DSN"),
@@ -66,21 +82,26 @@ class ModOverseer(commands.Bot):
         self.subreddit = reddit_config['subreddit']
         self.reddit = RedditClient(reddit_config['refresh_token'], reddit_config['client_id'], reddit_config['secret'],
                                    loop=self.loop)
+        discord_config = config['Discord']
+        self.guild_id = int(discord_config['guild_id'])
+        self.modqueue_channel_id = int(discord_config['modqueue_channel'])
+        self.subscriber_channel_id = int(discord_config['subscriber_count_channel'])
         self.queue_map = {}
+        self.entry_hash = {}
+        self._journal = open(QUEUE_JOURNAL_PATH, "ab", buffering=0)
 
         self.modqueue_check.add_exception_type(Exception)
-        self.subreddit_info_check.add_exception_type(Exception)
-        self.last_channel_update = self.now
-
-    @property
-    def now(self):
-        return datetime.datetime.now()
+        self.last_channel_update = time.monotonic()
+        self.last_subscriber_check = None
+        self._last_queue_count = -1
 
     async def setup_hook(self) -> None:
         await self.reddit.start()
+        await self.reddit.get_access_token()
 
     async def close(self) -> None:
         await self.reddit.stop()
+        self._journal.close()
 
     async def on_ready(self):
         """Called when the bot is ready."""
@@ -89,29 +110,17 @@ class ModOverseer(commands.Bot):
         print(self.user.id)
         print('------')
 
-        try:
-            with open("queue.json") as f:
-                self.queue_map = json.load(f)
-        except (FileNotFoundError, JSONDecodeError):
-            pass
+        self.load_queue_map()
 
-        self.subreddit_info_check.start()
         self.modqueue_check.start()
 
-
-    @tasks.loop(minutes=6)
-    async def subreddit_info_check(self):
+    async def update_subscriber_channel(self, guild: discord.Guild):
+        """Updates the name of the subscriber count channel with the subreddit's current subscribers."""
         tag = "[subreddit_info_check]"
-        await self.wait_until_ready()
-        guild: discord.Guild = self.get_guild(int(config["Discord"]["guild_id"]))
-        if guild is None:
-            log.warning(f"{tag} Could not find discord guild.")
+        if not self.subscriber_channel_id:
             return
-        channel_id = int(config["Discord"]["subscriber_count_channel"])
-        if not channel_id:
-            return
-        channel: discord.VoiceChannel = guild.get_channel(channel_id)
-        subreddit_info = await self.reddit.get_subreddit_about(config["Reddit"]["subreddit"])
+        channel: discord.VoiceChannel = guild.get_channel(self.subscriber_channel_id)
+        subreddit_info = await self.reddit.get_subreddit_about(self.subreddit)
         if channel is None:
             log.warning(f"{tag} Could not find channel.")
             return
@@ -124,65 +133,167 @@ class ModOverseer(commands.Bot):
             await channel.edit(name=new_name, reason="Subscriber count changed")
             log.info(f"{tag} Updated channel name to '{new_name}'")
 
-
-    @tasks.loop(minutes=6)
+    @tasks.loop(seconds=MIN_QUEUE_CHECK_INTERVAL)
     async def modqueue_check(self):
-        tag = "[subreddit_info_check]"
-        await self.wait_until_ready()
-        while self.is_ready():
+        tag = "[modqueue_check]"
+        guild: discord.Guild = self.get_guild(self.guild_id)
+        if guild is None:
+            log.warning(f"{tag} Could not find discord guild.")
+            return
+        # Subscriber count is updated from this same loop, at a slower cadence, independently of the queue
+        if (self.last_subscriber_check is None
+                or time.monotonic() - self.last_subscriber_check >= SUBSCRIBER_CHECK_INTERVAL):
+            self.last_subscriber_check = time.monotonic()
             try:
-                entries = await self.reddit.get_mod_queue(config["Reddit"]["subreddit"])
-                guild: discord.Guild = self.get_guild(int(config["Discord"]["guild_id"]))
-                if guild is None:
-                    log.warning(f"{tag} Could not find discord guild.")
-                    await asyncio.sleep(120)
-                    continue
-                channel: discord.TextChannel = guild.get_channel(int(config["Discord"]["modqueue_channel"]))
-                if channel is None:
-                    log.warning(f"{tag} Could not find channel.")
-                    await asyncio.sleep(120)
-                    continue
-                if entries is None:
-                    log.warning(f"{tag} Failed getting mod queue entries")
-                    await asyncio.sleep(60)
-                    continue
-                for r in entries:
-                    # New entry, add message
-                    if r.id not in self.queue_map:
-                        log.info(f"{tag} Adding new entry with id: {r.id}")
-                        msg = await channel.send(embed=self.embed_from_queue_entry(r))
-                        self.queue_map[r.id] = msg.id
-                    # Existing entry, update message
-                    else:
-                        msg = await self.safe_get_message(channel, self.queue_map[r.id])
-                        if msg:
-                            await msg.edit(embed=self.embed_from_queue_entry(r))
-                        else:
-                            log.info(f"{tag} Message for entry with id {r.id} not found, readding.")
-                            msg = await channel.send(embed=self.embed_from_queue_entry(r))
-                            self.queue_map[r.id] = msg.id
-                # Check entries that are now gone
-                temp = {k: v for k, v in self.queue_map.items()}
-                current_ids = [e.id for e in entries]
-                for entry_id, msg_id in temp.items():
-                    if entry_id not in current_ids:
-                        msg: discord.Message = await self.safe_get_message(channel, msg_id)
-                        if msg:
-                            await msg.delete()
-                        log.info(f"{tag} Entry with id {entry_id} no longer in queue")
-                        del self.queue_map[entry_id]
+                await self.update_subscriber_channel(guild)
+            except Exception:
+                log.exception("[subreddit_info_check] Exception")
+        try:
+            entries, delay = await self.reddit.get_mod_queue(self.subreddit)
+            # Next check is paced by Reddit's rate limit
+            self.modqueue_check.change_interval(seconds=max(delay, MIN_QUEUE_CHECK_INTERVAL))
+            channel: discord.TextChannel = guild.get_channel(self.modqueue_channel_id)
+            if channel is None:
+                log.warning(f"{tag} Could not find channel.")
+                return
+            if entries is None:
+                log.warning(f"{tag} Failed getting mod queue entries")
+                return
+            # Fetch recent messages in a single pass instead of fetching each entry's message
+            history_limit = max(100, len(self.queue_map) * 2)
+            messages = {m.id: m async for m in channel.history(limit=history_limit)}
+            results = await gather_bounded(self.sync_queue_entry(channel, r, messages) for r in entries)
+            # Check entries that are now gone
+            current_ids = {e.id for e in entries}
+            results += await gather_bounded(self.remove_queue_entry(channel, entry_id, messages)
+                                            for entry_id in self.queue_map.keys() - current_ids)
+            for result in results:
+                if isinstance(result, BaseException):
+                    log.error(f"{tag} Exception while syncing entry", exc_info=result)
+            if len(entries) != self._last_queue_count:
                 original_name = channel.name.split("·", 1)[0]
                 new_name = f"{original_name}·{len(entries)}"
+                if new_name == channel.name:
+                    self._last_queue_count = len(entries)
                 # Only update channel every 5 minutes, as the rate limit is 2 every 10 minutes.
-                if new_name != channel.name and (self.now - self.last_channel_update) > datetime.timedelta(minutes=5):
+                elif (time.monotonic() - self.last_channel_update) > 300:
                     await channel.edit(name=new_name, reason="Queue count changed")
-                    self.last_channel_update = self.now
-                with open("queue.json", "w") as f:
-                    json.dump(self.queue_map, f, indent=2)
-                await asyncio.sleep(120)
-            except Exception:
-                log.exception(f"{tag} Exception")
-                await asyncio.sleep(60)
+                    self.last_channel_update = time.monotonic()
+                    self._last_queue_count = len(entries)
+            await self.compact_queue_map()
+        except Exception:
+            log.exception(f"{tag} Exception")
+            self.modqueue_check.change_interval(seconds=60)
+
+    @modqueue_check.before_loop
+    async def before_modqueue_check(self):
+        await self.wait_until_ready()
+
+    async def sync_queue_entry(self, channel: discord.TextChannel, entry: Union[QueueCommentEntry, QueueLinkEntry],
+                               messages: Dict[int, discord.Message]):
+        """Adds or updates the message of a queue entry.
+
+        :param channel: The channel where the queue is displayed.
+        :param entry: The queue entry.
+        :param messages: Recent messages in the channel, by their id.
+        """
+        tag = "[modqueue_check]"
+        embed = self.embed_from_queue_entry(entry)
+        entry_hash = embed_fingerprint(embed)
+        # New entry, add message
+        if entry.id not in self.queue_map:
+            log.info(f"{tag} Adding new entry with id: {entry.id}")
+            msg = await channel.send(embed=embed)
+            self.journal_add(entry.id, msg.id, entry_hash)
+            return
+        # Existing entry, update message
+        msg = await self.get_cached_message(channel, self.queue_map[entry.id], messages)
+        if msg:
+            # Only edit if something visible in the embed changed
+            if entry_hash != self.entry_hash.get(entry.id):
+                await msg.edit(embed=embed)
+                self.journal_add(entry.id, msg.id, entry_hash)
+        else:
+            log.info(f"{tag} Message for entry with id {entry.id} not found, readding.")
+            msg = await channel.send(embed=embed)
+            self.journal_add(entry.id, msg.id, entry_hash)
+
+    async def remove_queue_entry(self, channel: discord.TextChannel, entry_id: str,
+                                 messages: Dict[int, discord.Message]):
+        """Removes an entry that is no longer in the queue, deleting its message."""
+        msg_id = self.journal_remove(entry_id)
+        msg: discord.Message = await self.get_cached_message(channel, msg_id, messages)
+        if msg:
+            await msg.delete()
+        log.info(f"[modqueue_check] Entry with id {entry_id} no longer in queue")
+
+    def load_queue_map(self):
+        """Loads the queue map from the last snapshot, then replays the journal on top of it."""
+        self.queue_map = {}
+        self.entry_hash = {}
+        try:
+            with open(QUEUE_SNAPSHOT_PATH, "rb") as f:
+                snapshot = orjson.loads(f.read())
+            if "messages" in snapshot:
+                self.queue_map = snapshot["messages"]
+                self.entry_hash = snapshot["hashes"]
+            else:
+                # Snapshots written before entry hashes were tracked only contain the message map.
+                self.queue_map = snapshot
+        except (FileNotFoundError, orjson.JSONDecodeError):
+            pass
+        try:
+            with open(QUEUE_JOURNAL_PATH, "rb") as f:
+                for line in f:
+                    try:
+                        record = orjson.loads(line)
+                    except orjson.JSONDecodeError:
+                        # A partially written last line, from an interrupted write.
+                        continue
+                    if "a" in record:
+                        self.queue_map[record["a"]] = record["m"]
+                        self.entry_hash[record["a"]] = record.get("h")
+                    else:
+                        self.queue_map.pop(record["d"], None)
+                        self.entry_hash.pop(record["d"], None)
+        except FileNotFoundError:
+            pass
+
+    def journal_add(self, entry_id: str, message_id: int, entry_hash: int):
+        """Maps a queue entry to a message and its content hash, recording the change in the journal."""
+        self.queue_map[entry_id] = message_id
+        self.entry_hash[entry_id] = entry_hash
+        self._journal.write(orjson.dumps({"a": entry_id, "m": message_id, "h": entry_hash}) + b"\n")
+
+    def journal_remove(self, entry_id: str) -> int:
+        """Removes a queue entry from the map, recording the change in the journal.
+
+        Returns the id of the message the entry was mapped to."""
+        message_id = self.queue_map.pop(entry_id)
+        self.entry_hash.pop(entry_id, None)
+        self._journal.write(orjson.dumps({"d": entry_id}) + b"\n")
+        return message_id
+
+    async def compact_queue_map(self):
+        """Writes a fresh snapshot of the queue map and truncates the journal, if the journal grew too big.
+
+        The snapshot is written in a separate thread, to avoid blocking the event loop."""
+        if os.path.getsize(QUEUE_JOURNAL_PATH) <= 10 * max(len(self.queue_map), 1) * JOURNAL_RECORD_SIZE:
+            return
+        snapshot = orjson.dumps({"messages": self.queue_map, "hashes": self.entry_hash}, option=orjson.OPT_INDENT_2)
+        await asyncio.to_thread(write_file_atomic, QUEUE_SNAPSHOT_PATH, snapshot)
+        self._journal.truncate(0)
+
+    @classmethod
+    async def get_cached_message(cls, channel: discord.TextChannel, message_id: int,
+                                 messages: Dict[int, discord.Message]) -> Optional[discord.Message]:
+        """Gets a message from a dictionary of already fetched messages.
+
+        If the message is not there, e.g. it is older than the fetched history, it is fetched individually."""
+        try:
+            return messages[message_id]
+        except KeyError:
+            return await cls.safe_get_message(channel, message_id)
 
     @staticmethod
     async def safe_get_message(channel: discord.TextChannel, message_id: int) -> Optional[discord.Message]:
@@ -205,27 +316,60 @@ class ModOverseer(commands.Bot):
     @staticmethod
     def embed_from_queue_entry(entry: Union[QueueCommentEntry, QueueLinkEntry]):
         """Builds a discord embed from a Mod Queue entry."""
-        embed = discord.Embed(title=entry.post_title, timestamp=entry.created)
         if isinstance(entry, QueueCommentEntry):
-            embed.title = f"Comment in '{entry.post_title}'"
-            embed.description = constrain(entry.comment_body, 2000)
-            embed.url = entry.comment_url
+            embed = discord.Embed(title=f"Comment in '{entry.post_title}'", url=entry.comment_url,
+                                  description=constrain(entry.comment_body, 2000), colour=COMMENT_COLOR,
+                                  timestamp=entry.created)
             embed.set_author(name=f"u/{entry.comment_author}", url=RedditClient.get_user_url(entry.comment_author))
         else:
-            embed.description = constrain(entry.post_text, 2000)
-            embed.url = entry.post_url
+            embed = discord.Embed(title=entry.post_title, url=entry.post_url,
+                                  description=constrain(entry.post_text, 2000), colour=LINK_COLOR,
+                                  timestamp=entry.created)
             if entry.data.thumbnail.startswith("http"):
                 embed.set_thumbnail(url=entry.data.thumbnail)
             embed.set_author(name=f"u/{entry.post_author}", url=RedditClient.get_user_url(entry.post_author))
-        embed.colour = COMMENT_COLOR if isinstance(entry, QueueCommentEntry) else LINK_COLOR
         if entry.user_reports:
-            embed.add_field(name="Reports", value="\n".join(f"{c}: {t}" for t, c, _, _ in entry.user_reports))
+            embed.add_field(name="Reports", value="\n".join(map(_REPORT_FMT, entry.user_reports)))
         if entry.mod_reports:
-            embed.add_field(name="Mod Reports", value="\n".join(f"{a}: {t}" for t, a in entry.mod_reports))
+            embed.add_field(name="Mod Reports", value="\n".join(map(_MODREPORT_FMT, entry.mod_reports)))
         embed.set_footer(text=f"Score: {entry.score}")
         return embed
 
 
+async def gather_bounded(coros, limit: int = MAX_CONCURRENT_REQUESTS) -> list:
+    """Runs coroutines concurrently, with at most `limit` of them running at the same time.
+
+    Exceptions are returned in the results instead of being raised."""
+    semaphore = asyncio.Semaphore(limit)
+
+    async def bounded(coro):
+        async with semaphore:
+            return await coro
+
+    return await asyncio.gather(*(bounded(c) for c in coros), return_exceptions=True)
+
+
+def write_file_atomic(path: str, content: bytes):
+    """Writes a file by writing to a temporary file first and then replacing it.
+
+    This way, the file is never left partially written."""
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(content)
+    try:
+        os.replace(temp_path, path)
+    except OSError:
+        # Files that are bind mounts (e.g. in docker) can't be replaced, only written to.
+        os.remove(temp_path)
+        with open(path, "wb") as f:
+            f.write(content)
+
+
+def embed_fingerprint(embed: discord.Embed) -> int:
+    """Builds a stable hash of an embed's contents, to detect whether a message needs to be edited."""
+    return zlib.crc32(orjson.dumps(embed.to_dict(), option=orjson.OPT_SORT_KEYS))
+
+
 def constrain(content: str, limit: int):
     """Limit a string's length."""
     return content if len(content) < limit else f"{content[:limit - 3]}[…]"
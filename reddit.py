@@ -1,16 +1,30 @@
+import asyncio
+import contextlib
 import datetime
-import enum
+import functools
 import html
 import logging
-from abc import ABC, ABCMeta, abstractmethod, abstractproperty
+import time
+from abc import ABCMeta, abstractmethod
 from typing import Annotated, List, Literal, Optional, Tuple, Union
 
 import aiohttp
+import orjson
 from pydantic import BaseModel, Field
 
+try:
+    import aiodns
+except ImportError:
+    aiodns = None
+
 ACCESS_TOKEN_URL = "https://www.reddit.com/api/v1/access_token"
 OAUTH_BASE_URL = "https://oauth.reddit.com"
+BASE_URL = "https://reddit.com"
 USER_AGENT = "ModOverseer by /u/Galarzaa"
+_UTC = datetime.timezone.utc
+_FROMTS = datetime.datetime.fromtimestamp
+# Seconds before the access token expires to refresh it in the background.
+TOKEN_REFRESH_MARGIN = 60
 
 log = logging.getLogger("overseer")
 
@@ -18,13 +32,20 @@ log = logging.getLogger("overseer")
 def token_request(func):
     """Makes sure the current token is valid before performing a request.
 
-    If the token is expired or there's no saved token yet, a new access token is requested."""
-
-    async def wrapper(*args):
-        # If token is expired, get new token before
-        if args[0].token is None or datetime.datetime.now() >= args[0].expire_time:
-            await args[0].get_access_token()
-        return await func(*args)
+    If the token is expired or there's no saved token yet, a new access token is requested.
+    If the token is about to expire, a new one is requested in the background and the current one is used.
+    Tokens are normally refreshed in the background before they expire, so this is only a fallback."""
+
+    @functools.wraps(func)
+    async def wrapper(self, *args):
+        if self.token_expired:
+            # Only one caller refreshes the token, the rest wait for it.
+            async with self._auth_lock:
+                if self.token_expired:
+                    await self.get_access_token()
+        elif self.token_stale:
+            self._start_refresh()
+        return await func(self, *args)
 
     return wrapper
 
@@ -45,81 +66,129 @@ class RedditClient:
         :param loop: The event loop used by the client.
         """
         self.refresh_token = refresh_token
+        self._refresh_params = {
+            'grant_type': 'refresh_token',
+            'refresh_token': refresh_token
+        }
         self.auth = aiohttp.BasicAuth(client, secret)
         self.client = client
         self.secret = secret
-        self.auth_session: aiohttp.ClientSession = None
-        self.api_session: aiohttp.ClientSession = None
+        self.session: aiohttp.ClientSession = None
+        self.api_headers = {}
         self.expire_time = None
+        self.stale_time = None
         self.token = None
+        self._auth_lock = asyncio.Lock()
+        self._refresh_handle: Optional[asyncio.TimerHandle] = None
+        self._refresh_task: Optional[asyncio.Task] = None
+
+    @property
+    def token_expired(self) -> bool:
+        """Whether there is no access token or it's already expired."""
+        return self.token is None or time.monotonic() >= self.expire_time
+
+    @property
+    def token_stale(self) -> bool:
+        """Whether the access token is close to expiring and should be refreshed."""
+        return self.stale_time is not None and time.monotonic() >= self.stale_time
 
     async def start(self):
-        self.auth_session = aiohttp.ClientSession(auth=self.auth, headers={'User-Agent': USER_AGENT})
+        # Connections and DNS lookups are kept alive between polls
+        connector = aiohttp.TCPConnector(limit=10, limit_per_host=5, ttl_dns_cache=600, keepalive_timeout=60,
+                                         resolver=aiohttp.AsyncResolver() if aiodns else None)
+        self.session = aiohttp.ClientSession(headers={'User-Agent': USER_AGENT}, connector=connector,
+                                             json_serialize=lambda o: orjson.dumps(o).decode())
 
     async def stop(self):
-        await self.auth_session.close()
-        if self.api_session:
-            await self.api_session.close()
+        if self._refresh_handle:
+            self._refresh_handle.cancel()
+        # A refresh already in progress would fail once the session is closed
+        if self._refresh_task is not None and not self._refresh_task.done():
+            self._refresh_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._refresh_task
+        await self.session.close()
 
     async def get_access_token(self):
         """Gets a new access token using the current refresh token."""
-        log.info(f"[{self.__class__.__name__}] Getting access token")
+        log.info("[%s] Getting access token", self.__class__.__name__)
         try:
-            params = {
-                'grant_type': 'refresh_token',
-                'refresh_token': self.refresh_token
-            }
-            async with self.auth_session.post(ACCESS_TOKEN_URL, data=params) as resp:
-                data = await resp.json()
+            async with self.session.post(ACCESS_TOKEN_URL, data=self._refresh_params, auth=self.auth) as resp:
+                data = await resp.json(loads=orjson.loads)
                 self.token = data['access_token']
-                self.expire_time = datetime.datetime.now() + datetime.timedelta(seconds=data['expires_in'] - 10)
-                self.api_session = aiohttp.ClientSession(headers={
-                    'User-Agent': USER_AGENT,
-                    'Authorization': f'bearer {self.token}'
-                })
-                log.info(f"[{self.__class__.__name__}] Access token obtained.")
+                self.expire_time = time.monotonic() + data['expires_in'] - 10
+                self.stale_time = self.expire_time - TOKEN_REFRESH_MARGIN
+                self.api_headers = {'Authorization': f'bearer {self.token}'}
+                log.info("[%s] Access token obtained.", self.__class__.__name__)
+                self._schedule_refresh(data['expires_in'])
                 return True
-        except Exception as e:
-            log.exception(f"[{self.__class__.__name__}] Exception while getting access token.")
+        except (aiohttp.ClientError, asyncio.TimeoutError, KeyError, ValueError):
+            log.exception("[%s] Exception while getting access token.", self.__class__.__name__)
             return False
 
+    def _schedule_refresh(self, expires_in: int):
+        """Schedules getting a new access token shortly before the current one expires."""
+        if self._refresh_handle:
+            self._refresh_handle.cancel()
+        loop = asyncio.get_running_loop()
+        self._refresh_handle = loop.call_later(max(expires_in - TOKEN_REFRESH_MARGIN, 0), self._start_refresh)
+
+    def _start_refresh(self):
+        """Starts getting a new access token in the background, unless a refresh is already in progress."""
+        if self._refresh_task is not None and not self._refresh_task.done():
+            return
+        self._refresh_task = asyncio.create_task(self._refresh_access_token())
+
+    async def _refresh_access_token(self):
+        async with self._auth_lock:
+            if self.token_stale or self.token_expired:
+                await self.get_access_token()
+
     @token_request
-    async def get_mod_queue(self, subreddit) -> List[Union['QueueCommentEntry', 'QueueLinkEntry']]:
-        """Gets the current ModQueue contents."""
-        log.info(f"[{self.__class__.__name__}] Getting modqueue")
-        async with self.api_session.get(f"{OAUTH_BASE_URL}/r/{subreddit}/about/modqueue") as resp:
+    async def get_mod_queue(self, subreddit) -> Tuple[Optional[List[Union['QueueCommentEntry', 'QueueLinkEntry']]], float]:
+        """Gets the current ModQueue contents.
+
+        Along with the entries, it returns the seconds to wait before the next request to stay within rate limits.
+        If the request was rate limited, no entries are returned.
+        HTTP and validation errors are raised to the caller."""
+        log.info("[%s] Getting modqueue", self.__class__.__name__)
+        async with self.session.get(self.get_subreddit_url(subreddit, "about/modqueue"), headers=self.api_headers) as resp:
+            remaining, reset = self.parse_ratelimit(resp)
+            if resp.status == 429:
+                log.warning("[%s] Rate limited, retrying in %.0f seconds.", self.__class__.__name__, reset)
+                return None, reset + 2
             resp.raise_for_status()
-            js = await resp.json()
-            try:
-                listing = RedditListing.model_validate(js)
-                log.info(f"[{self.__class__.__name__}] {len(listing.data.children)} queue entries found.")
-                return listing.data.children
-            except Exception:
-                log.exception(f"[{self.__class__.__name__}] Exception while getting mod queue.")
-                raise
+            # Parsing and validation happen in a single pass, without building intermediate dicts
+            listing = RedditListing.model_validate_json(await resp.read())
+            log.info("[%s] %d queue entries found.", self.__class__.__name__, len(listing.data.children))
+            return listing.data.children, reset / max(remaining, 1)
 
     @token_request
     async def get_subreddit_about(self, subreddit):
         """Gets the general info of a subreddit."""
-        log.info(f"[{self.__class__.__name__}] Getting subreddit info")
-        async with self.api_session.get(f"{OAUTH_BASE_URL}/r/{subreddit}/about") as resp:
-            js = await resp.json()
+        log.info("[%s] Getting subreddit info", self.__class__.__name__)
+        async with self.session.get(self.get_subreddit_url(subreddit, "about"), headers=self.api_headers) as resp:
+            js = await resp.json(loads=orjson.loads)
             if "error" in js:
                 return None
-            try:
-                return AboutSubreddit(**js["data"])
-            except Exception as e:
-                log.exception(f"[{self.__class__.__name__}] Exception while getting subreddit's information.")
-                raise
+            return AboutSubreddit(**js["data"])
 
     @staticmethod
-    def get_user_url(username: str) -> str:
-        return f"https://www.reddit.com/u/{username}"
+    def parse_ratelimit(resp: aiohttp.ClientResponse) -> Tuple[float, float]:
+        """Gets the remaining requests and the seconds until the rate limit window resets from a response."""
+        remaining = float(resp.headers.get('X-Ratelimit-Remaining', 60))
+        reset = float(resp.headers.get('X-Ratelimit-Reset', 60))
+        return remaining, reset
 
+    @staticmethod
+    @functools.lru_cache(maxsize=32)
+    def get_subreddit_url(subreddit: str, path: str) -> str:
+        return f"{OAUTH_BASE_URL}/r/{subreddit}/{path}"
 
-class EntryKind(enum.Enum):
-    LINK = "t3"
-    COMMENT = "t1"
+    @staticmethod
+    @functools.lru_cache(maxsize=1024)
+    def get_user_url(username: str) -> str:
+        return f"https://www.reddit.com/u/{username}"
 
 
 class AboutSubreddit:
@@ -130,6 +199,15 @@ class AboutSubreddit:
 
 
 class CommonQueueEntry(metaclass=ABCMeta):
+    """Common interface of mod queue entries.
+
+    Entries are identified by their id, they compare equal to other entries or strings with the same id."""
+
+    def __eq__(self, other):
+        return self.id == getattr(other, "id", other)
+
+    def __hash__(self):
+        return hash(self.id)
 
     @property
     @abstractmethod
@@ -174,51 +252,26 @@ class CommonQueueEntry(metaclass=ABCMeta):
 
 
 class CommonData(BaseModel):
+    """Fields shared by comments and links in the mod queue.
+
+    Only the fields used by the bot are declared, the rest of the payload is skipped while parsing."""
     user_reports: List[Tuple[str, int, bool, bool]]
     mod_reports: List[Tuple[str, str]]
-    ups: int
     score: int
-    approved_by: Optional[str]
-    approved: bool
-    created_utc: datetime.datetime
+    created_utc: float
     permalink: str
-    num_reports: int
-    mod_reason_by: Optional[str]
-    removed: bool
     id: str
 
 
 class CommentData(CommonData):
-    approved_at_utc: Optional[datetime.datetime]
-    author_is_blocked: bool
-    edited: Union[bool | float]
-    banned_by: Optional[Union[bool, str]] = None
-    author_flair_type: str
-    total_awards_received: int
     author: str
     link_author: str
-    likes: Optional[int]
-    ban_note: Optional[str] = None
-    banned_at_utc: Optional[datetime.datetime]
-    mod_reason_title: Optional[str]
-    num_comments: int
-    parent_id: str
-    author_fullname: str
     body: str
     link_title: str
-    name: str
-    downs: int
-    is_submitter: bool
-    link_id: str
-    score_hidden: bool
     link_permalink: str
-    report_reasons: List
-    created: datetime.datetime
-    link_url: str
-    locked: bool
 
 
-class QueueCommentEntry(BaseModel, CommonQueueEntry):
+class QueueCommentEntry(CommonQueueEntry, BaseModel):
     kind: Literal['t1']
     data: CommentData
 
@@ -226,7 +279,7 @@ class QueueCommentEntry(BaseModel, CommonQueueEntry):
     def id(self):
         return self.data.id
 
-    @property
+    @functools.cached_property
     def post_title(self):
         return html.unescape(self.data.link_title)
 
@@ -238,9 +291,9 @@ class QueueCommentEntry(BaseModel, CommonQueueEntry):
     def post_url(self):
         return self.data.link_permalink
 
-    @property
+    @functools.cached_property
     def created(self):
-        return self.data.created_utc
+        return _FROMTS(self.data.created_utc, _UTC)
 
     @property
     def user_reports(self):
@@ -262,26 +315,20 @@ class QueueCommentEntry(BaseModel, CommonQueueEntry):
     def comment_author(self):
         return self.data.author
 
-    @property
+    @functools.cached_property
     def comment_url(self):
-        return f"https://reddit.com{self.data.permalink}"
+        return BASE_URL + self.data.permalink
 
 
 class LinkData(CommonData):
-    approved_at_utc: Optional[datetime.datetime]
     selftext: str
     title: str
-    upvote_ratio: float
-    ignore_reports: bool
-    is_original_content: bool
-    author_is_blocked: bool
     author: str
     url: str
-    is_self: bool
     thumbnail: str
 
 
-class QueueLinkEntry(BaseModel, CommonQueueEntry):
+class QueueLinkEntry(CommonQueueEntry, BaseModel):
     kind: Literal['t3']
     data: LinkData
 
@@ -289,7 +336,7 @@ class QueueLinkEntry(BaseModel, CommonQueueEntry):
     def id(self):
         return self.data.id
 
-    @property
+    @functools.cached_property
     def post_title(self):
         return html.unescape(self.data.title)
 
@@ -297,9 +344,9 @@ class QueueLinkEntry(BaseModel, CommonQueueEntry):
     def post_author(self):
         return self.data.author
 
-    @property
+    @functools.cached_property
     def created(self):
-        return self.data.created_utc
+        return _FROMTS(self.data.created_utc, _UTC)
 
     @property
     def user_reports(self):